@@ -14,15 +14,24 @@
 """Perform assembly based on debruijn graph."""
 
 import argparse
+import gzip
+import mmap
+import multiprocessing
 import os
 import sys
 import networkx as nx
+import numpy as np
 import matplotlib
+from collections import namedtuple
 from operator import itemgetter
 import random
 random.seed(9001)
 from random import randint
 import statistics
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 __author__ = "Charlotte des Mares de Trébons"
 __copyright__ = "Universite Paris Diderot"
@@ -33,6 +42,19 @@ __maintainer__ = "Charlotte des Mares de Trébons"
 __email__ = "chadmdt@outlook.fr"
 __status__ = "Developpement"
 
+NUCLEOTIDES = "ACGT"
+# Largest k-mer that fits in a 64 bits integer with 2 bits per nucleotide
+MAX_PACKED_KMER_SIZE = 31
+# Input size from which k-mers are counted on every available cpu
+PARALLEL_MIN_SIZE = 1 << 24
+# Lookup table from ASCII code to 2 bits nucleotide code (255 if invalid)
+NUC_LUT = np.full(256, 255, dtype=np.uint8)
+NUC_LUT[[ord(nuc) for nuc in NUCLEOTIDES]] = np.arange(4, dtype=np.uint8)
+
+# Compressed sparse row adjacency of a graph, node ids index nodes
+CSRGraph = namedtuple("CSRGraph", ["nodes", "node_id", "indptr", "indices",
+                                   "weights"])
+
 def isfile(path):
     """Check if path is an existing file.
       :Parameters:
@@ -67,77 +89,301 @@ def get_arguments():
     return parser.parse_args()
 
 
+def read_fastq_bytes(fastq_file):
+    """Yield the sequence of each fastq record as bytes.
+      Plain files are memory mapped, files ending with .gz are streamed
+      through gzip.
+    """
+    if fastq_file.endswith(".gz"):
+        with gzip.open(fastq_file, "rb") as file:
+            for i, line in enumerate(file):
+                if i & 3 == 1:
+                    yield line.rstrip()
+        return
+    with open(fastq_file, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield from iter_sequences(buf, 0, len(buf))
+
+def iter_sequences(buf, start, end):
+    """Yield the sequence lines of the fastq records held in buf[start:end].
+      :Parameters:
+          buf: Buffer of a plain fastq file (mmap or bytes)
+          start: Offset of the first record
+          end: Offset of the end of the last record
+    """
+    offset = start
+    line_idx = 0
+    while offset < end:
+        line_end = buf.find(b"\n", offset, end)
+        if line_end == -1:
+            line_end = end
+        if line_idx & 3 == 1:
+            yield buf[offset:line_end].rstrip()
+        offset = line_end + 1
+        line_idx += 1
+
+def find_record_start(buf, offset):
+    """Return the offset of the first fastq record starting after offset.
+      A quality line may start with '@' too, a record start is only accepted
+      when its third line starts with '+'.
+    """
+    while True:
+        pos = buf.find(b"\n@", offset)
+        if pos == -1:
+            return len(buf)
+        header_end = buf.find(b"\n", pos + 1)
+        sequence_end = buf.find(b"\n", header_end + 1) if header_end != -1 else -1
+        if sequence_end == -1:
+            return len(buf)
+        if buf[sequence_end+1:sequence_end+2] == b"+":
+            return pos + 1
+        offset = pos + 1
+
+def split_fastq(fastq_file, nb_chunks):
+    """Split a plain fastq file in byte ranges aligned on records.
+      :Parameters:
+          fastq_file: Path to the fastq file
+          nb_chunks: Maximum number of ranges
+      Returns: A list of (start, end) offsets
+    """
+    with open(fastq_file, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            bounds = [0]
+            for i in range(1, nb_chunks):
+                bound = find_record_start(buf, max(i * size // nb_chunks,
+                                                   bounds[-1]))
+                if bound >= size:
+                    break
+                if bound > bounds[-1]:
+                    bounds.append(bound)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
 def read_fastq(fastq_file):
-    with open(fastq_file) as file:
-        i = 0
-        for line in file:
-            i += 1
-            if i%2==0 and i%4!=0:
-                yield line.rstrip()
+    for read in read_fastq_bytes(fastq_file):
+        yield read.decode()
 
 def cut_kmer(read, kmer_size):
     for i in range(0,len(read)-kmer_size+1):
         yield read[i:i+kmer_size]
 
+def pack_kmers_numpy(arr, kmer_size):
+    """Pack each k-mer of a read (uint8 array) into a uint64, vectorized.
+      K-mers holding a non ACGT character are skipped.
+    """
+    arr = NUC_LUT[arr]
+    nb_kmer = len(arr) - kmer_size + 1
+    if nb_kmer <= 0:
+        return np.empty(0, dtype=np.uint64)
+    codes = np.zeros(nb_kmer, dtype=np.uint64)
+    for j in range(kmer_size):
+        codes <<= np.uint64(2)
+        codes |= arr[j:j+nb_kmer]
+    invalid = np.concatenate(([0], np.cumsum(arr == 255)))
+    return codes[invalid[kmer_size:] == invalid[:-kmer_size]]
+
+def pack_kmers_loop(arr, kmer_size):
+    """Pack each k-mer of a read (uint8 array) into a uint64 with a rolling
+      code, meant to be compiled with numba.
+      K-mers holding a non ACGT character are skipped.
+    """
+    codes = np.empty(max(len(arr) - kmer_size + 1, 0), dtype=np.uint64)
+    mask = np.uint64((1 << (2 * kmer_size)) - 1)
+    code = np.uint64(0)
+    nb_valid = 0
+    nb_kmer = 0
+    for i in range(len(arr)):
+        nuc = NUC_LUT[arr[i]]
+        if nuc == 255:
+            nb_valid = 0
+            continue
+        code = ((code << np.uint64(2)) | np.uint64(nuc)) & mask
+        nb_valid += 1
+        if nb_valid >= kmer_size:
+            codes[nb_kmer] = code
+            nb_kmer += 1
+    return codes[:nb_kmer]
+
+if njit is None:
+    pack_kmers = pack_kmers_numpy
+else:
+    pack_kmers = njit(cache=True)(pack_kmers_loop)
+
+def cut_kmer_array(read, kmer_size):
+    """Return a zero copy (n_windows, kmer_size) uint8 view of the k-mers of
+      a read (bytes).
+    """
+    return np.lib.stride_tricks.sliding_window_view(
+        np.frombuffer(read, dtype=np.uint8), kmer_size)
+
+def encode_kmers(read, kmer_size):
+    """Return the 2 bits packed code of each k-mer of a read (bytes).
+      K-mers holding a non ACGT character are skipped.
+    """
+    return pack_kmers(np.frombuffer(read, dtype=np.uint8), kmer_size)
+
+def decode_kmers(codes, kmer_size):
+    """Return the nucleotide sequences of an array of packed k-mers"""
+    shifts = np.arange(2 * (kmer_size - 1), -1, -2, dtype=np.uint64)
+    digits = (codes[:, None] >> shifts) & np.uint64(3)
+    letters = np.frombuffer(NUCLEOTIDES.encode(), dtype=np.uint8)[digits]
+    text = letters.tobytes().decode()
+    return [text[i:i+kmer_size] for i in range(0, len(text), kmer_size)]
+
+def encode_kmer(kmer):
+    """Return the 2 bits packed code of a k-mer"""
+    code = 0
+    for nuc in kmer:
+        code = (code << 2) | NUCLEOTIDES.index(nuc)
+    return code
+
+def decode_kmer(code, kmer_size):
+    """Return the nucleotide sequence of a packed k-mer"""
+    return "".join(NUCLEOTIDES[(code >> 2*i) & 3]
+                   for i in range(kmer_size - 1, -1, -1))
+
+def tally_kmers(codes, kmer_size):
+    """Return the distinct packed k-mers (uint64) and their occurrences"""
+    if 4 ** kmer_size <= len(codes):
+        # Dense table no larger than the k-mers themselves
+        counts = np.bincount(codes.astype(np.int64), minlength=4 ** kmer_size)
+        kmers = np.flatnonzero(counts)
+        return kmers.astype(np.uint64), counts[kmers]
+    return np.unique(codes, return_counts=True)
+
+def count_kmers_chunk(fastq_file, kmer_size, start, end):
+    """Tally the k-mers of the records held in a byte range of a fastq file"""
+    with open(fastq_file, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            reads = b"\n".join(iter_sequences(buf, start, end))
+    return tally_kmers(encode_kmers(reads, kmer_size), kmer_size)
+
+def available_cpus():
+    """Return the number of cpus this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def count_kmers(fastq_file, kmer_size, nb_process=None):
+    """Count k-mer occurrences, k-mers being keyed on their packed code.
+      :Parameters:
+          fastq_file: Path to the fastq file
+          kmer_size: Size of the k-mers (at most MAX_PACKED_KMER_SIZE)
+          nb_process: Number of processes, by default every available cpu
+                      for plain files larger than PARALLEL_MIN_SIZE
+      Returns: A dictionary {code: occurrences}
+    """
+    if nb_process is None:
+        nb_process = 1
+        if os.path.getsize(fastq_file) >= PARALLEL_MIN_SIZE:
+            nb_process = available_cpus()
+    if (nb_process <= 1 or fastq_file.endswith(".gz")
+            or "fork" not in multiprocessing.get_all_start_methods()):
+        # Reads are joined on a non ACGT separator to be encoded in one call
+        codes = encode_kmers(b"\n".join(read_fastq_bytes(fastq_file)),
+                             kmer_size)
+        kmers, counts = tally_kmers(codes, kmer_size)
+        return dict(zip(kmers.tolist(), counts.tolist()))
+    chunks = [(fastq_file, kmer_size, start, end)
+              for start, end in split_fastq(fastq_file, nb_process)]
+    # Compile (or load) the encoder once so that forked workers inherit it
+    encode_kmers(NUCLEOTIDES.encode(), kmer_size)
+    with multiprocessing.get_context("fork").Pool(nb_process) as pool:
+        tallies = list(pool.starmap(count_kmers_chunk, chunks))
+    if not tallies:
+        return {}
+    kmers = np.concatenate([tally[0] for tally in tallies])
+    counts = np.concatenate([tally[1] for tally in tallies])
+    order = np.argsort(kmers, kind="stable")
+    kmers = kmers[order]
+    starts = np.flatnonzero(np.concatenate(([True], kmers[1:] != kmers[:-1])))
+    counts = np.add.reduceat(counts[order], starts)
+    return dict(zip(kmers[starts].tolist(), counts.tolist()))
+
 def build_kmer_dict(fastq_file, kmer_size):
-    dict = {}
-    for line in read_fastq(fastq_file):
-        for kmer in cut_kmer(line, kmer_size):
-            occ = dict.pop(kmer, None)
-            if occ != None:
-                dict[kmer] = occ + 1
-            else:
-                dict[kmer] = 1
-    return dict
-
-def build_graph(kmer_dict):
+    if kmer_size > MAX_PACKED_KMER_SIZE:
+        # Reads are joined on a newline, k-mers holding it or any other non
+        # ACGT character are dropped as in the packed path
+        reads = b"\n".join(read_fastq_bytes(fastq_file))
+        if len(reads) < kmer_size:
+            return {}
+        windows = cut_kmer_array(reads, kmer_size)
+        invalid = np.concatenate(([0], np.cumsum(
+            NUC_LUT[np.frombuffer(reads, dtype=np.uint8)] == 255)))
+        valid = invalid[kmer_size:] == invalid[:-kmer_size]
+        kmers, counts = np.unique(windows.view("S{0}".format(kmer_size))[valid, 0],
+                                  return_counts=True)
+        return dict(zip((kmer.decode() for kmer in kmers.tolist()),
+                        counts.tolist()))
+    kmer_codes = count_kmers(fastq_file, kmer_size)
+    kmers = np.fromiter(kmer_codes, dtype=np.uint64, count=len(kmer_codes))
+    return dict(zip(decode_kmers(kmers, kmer_size), kmer_codes.values()))
+
+def build_graph(kmer_dict, kmer_size=None):
+    """Build the de Bruijn graph of the k-mers.
+      :Parameters:
+          kmer_dict: Dictionary of k-mer occurrences
+          kmer_size: Size of the k-mers when they are given as packed codes
+                     (see count_kmers), nodes are then packed codes too
+    """
     digraph = nx.DiGraph()
-    for kmer in kmer_dict.keys():
-        digraph.add_edge(kmer[:-1],kmer[1:],weight=kmer_dict[kmer])
+    if kmer_size is None:
+        digraph.add_weighted_edges_from((kmer[:-1], kmer[1:], weight)
+                                        for kmer, weight in kmer_dict.items())
+    else:
+        digraph.graph["kmer_size"] = kmer_size
+        mask = (1 << 2*(kmer_size - 1)) - 1
+        digraph.add_weighted_edges_from((code >> 2, code & mask, weight)
+                                        for code, weight in kmer_dict.items())
     return digraph
 
 def remove_paths(graph, path_list, delete_entry_node, delete_sink_node):
+    start = 0 if delete_entry_node else 1
+    end = None if delete_sink_node else -1
+    nodes = set()
     for path in path_list:
-        if delete_entry_node is True and delete_sink_node is True:
-            graph.remove_nodes_from(path)
-        elif delete_entry_node is True and delete_sink_node is False:
-            graph.remove_nodes_from(path[:-1])
-        elif delete_entry_node is False and delete_sink_node is True:
-            graph.remove_nodes_from(path[1:])
-        else:
-            graph.remove_nodes_from(path[1:-1])
+        nodes.update(path[start:end])
+    graph.remove_nodes_from(nodes)
     return graph
 
 def std(data):
-    if len(data) == 1:
+    if len(data) < 2:
         return 0
     return statistics.stdev(data)
 
+def argmax(data):
+    """Return the index of the first maximum of data in a single pass"""
+    return max(range(len(data)), key=data.__getitem__)
+
+def choose_best(weight_avg_list, path_length, path_list):
+    """Return the index of the heaviest path, else of the longest one, else
+      of a random one.
+    """
+    if std(weight_avg_list) > 0:
+        return argmax(weight_avg_list)
+    if std(path_length) > 0:
+        return argmax(path_length)
+    return randint(0,len(path_list)-1)
+
 def select_best_path(graph, path_list, path_length, weight_avg_list,
                      delete_entry_node=False, delete_sink_node=False):
-    if std(weight_avg_list) > 0:
-        best_index = weight_avg_list.index(max(weight_avg_list))
-        del path_list[best_index]
-        return remove_paths(graph,path_list,delete_entry_node,delete_sink_node)
-    elif std(path_length) > 0:
-        best_index = path_length.index(max(path_length))
-        del path_list[best_index]
-        return remove_paths(graph,path_list,delete_entry_node,delete_sink_node)
-    else:
-        best_index = randint(0,len(path_list)-1)
-        del path_list[best_index]
-        return remove_paths(graph,path_list,delete_entry_node,delete_sink_node)
+    del path_list[choose_best(weight_avg_list, path_length, path_list)]
+    return remove_paths(graph,path_list,delete_entry_node,delete_sink_node)
 
 def path_average_weight(graph, path):
-    return statistics.mean([d["weight"] for (u, v, d) in graph.subgraph(path).edges(data=True)])
+    return statistics.fmean(graph[u][v]["weight"] for u, v in zip(path, path[1:]))
 
 def solve_bubble(graph, ancestor_node, descendant_node):
-    path_list = [p for p in nx.all_simple_paths(graph,ancestor_node,descendant_node)]
-    path_length = []
-    weight_avg_list = []
-    for path in path_list:
-        path_length.append(len(path))
-        weight_avg_list.append(path_average_weight(graph,path))
+    path_list = list(bidirectional_simple_paths(graph, ancestor_node,
+                                                descendant_node))
+    weight_avg_list = [weight for _, weight in path_list]
+    path_list = [path for path, _ in path_list]
+    path_length = [len(path) for path in path_list]
     return select_best_path(graph, path_list, path_length, weight_avg_list)
 
 def simplify_bubbles(graph):
@@ -201,39 +447,154 @@ def solve_out_tips(graph, ending_nodes):
     return graph
 
 def get_starting_nodes(graph):
-    node_list = []
-    for node in graph.nodes():
-        if len([p for p in graph.predecessors(node)]) == 0:
-            node_list.append(node)
-    return node_list
+    return [node for node, degree in graph.in_degree() if degree == 0]
 
 def get_sink_nodes(graph):
-    node_list = []
-    for node in graph.nodes():
-        if len([p for p in graph.successors(node)]) == 0:
-            node_list.append(node)
-    return node_list
+    return [node for node, degree in graph.out_degree() if degree == 0]
 
-def get_contigs(graph, starting_nodes, ending_nodes):
-    result = []
+def build_csr(graph):
+    """Build the compressed sparse row adjacency of a graph.
+      Successors of node id i are indices[indptr[i]:indptr[i+1]], the
+      weights of the matching edges are stored alongside.
+      Returns: A CSRGraph
+    """
+    nodes = list(graph)
+    node_id = {node: i for i, node in enumerate(nodes)}
+    adj = graph.adj
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter((len(adj[node]) for node in nodes), dtype=np.int64,
+                          count=len(nodes)), out=indptr[1:])
+    indices = np.fromiter((node_id[succ] for node in nodes for succ in adj[node]),
+                          dtype=np.int64, count=indptr[-1])
+    weights = np.fromiter((data.get("weight", 1) for node in nodes
+                           for data in adj[node].values()),
+                          dtype=np.float64, count=indptr[-1])
+    return CSRGraph(nodes, node_id, indptr, indices, weights)
+
+def csr_simple_paths(indptr, indices, source, target, cutoff=None):
+    """Yield every simple path (list of node ids) from source to target
+      with an iterative depth first search on a CSR adjacency.
+      :Parameters:
+          indptr, indices: CSR adjacency (see build_csr)
+          source, target: Node ids
+          cutoff: Maximum number of edges of a path (default: no limit)
+    """
+    if source == target:
+        return
+    if cutoff is None:
+        cutoff = len(indptr) - 2
+    # Ordered dict used both as the current path and its membership set
+    visited = dict.fromkeys([source])
+    stack = [iter(indices[indptr[source]:indptr[source+1]].tolist())]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            visited.popitem()
+        elif child == target:
+            yield list(visited) + [target]
+        elif child not in visited and len(visited) < cutoff:
+            visited[child] = None
+            stack.append(iter(indices[indptr[child]:indptr[child+1]].tolist()))
+
+def extend_half_paths(half_paths, adjacency, stop):
+    """Extend each half path (nodes, weight sum) by one edge of adjacency
+      (graph.succ or graph.pred), half paths ending on stop are not
+      extended.
+    """
+    extended = []
+    for nodes, weight_sum in half_paths:
+        node = nodes[-1]
+        if node == stop:
+            continue
+        for child, data in adjacency[node].items():
+            if child not in nodes:
+                extended.append((nodes + (child,),
+                                 weight_sum + data.get("weight", 1)))
+    return extended
+
+def bidirectional_simple_paths(graph, source, target, cutoff=None):
+    """Yield the simple paths from source to target by increasing length,
+      along with their average edge weight.
+      A forward tree grows from source and a backward tree from target one
+      level at a time, a path of l edges is spliced from a forward half of
+      ceil(l/2) edges and a backward half of floor(l/2) edges meeting on
+      the same node. Half paths carry the sum of their edge weights.
+      :Parameters:
+          graph: A networkx DiGraph
+          source, target: Nodes of the graph
+          cutoff: Maximum number of edges of a path (default: no limit)
+    """
+    if source == target:
+        return
+    if cutoff is None:
+        cutoff = len(graph) - 1
+    # Only the deepest level of each tree is kept, the backward halves
+    # being indexed by their meeting node
+    forward_level = [((source,), 0.0)]
+    forward_depth = 0
+    backward_level = [((target,), 0.0)]
+    backward_depth = 0
+    meeting = {target: backward_level}
+    for length in range(1, cutoff + 1):
+        if forward_depth < (length + 1) // 2:
+            forward_level = extend_half_paths(forward_level, graph.succ, target)
+            forward_depth += 1
+        if backward_depth < length // 2:
+            backward_level = extend_half_paths(backward_level, graph.pred,
+                                               source)
+            backward_depth += 1
+            meeting = {}
+            for half_path in backward_level:
+                meeting.setdefault(half_path[0][-1], []).append(half_path)
+        if not forward_level or not backward_level:
+            return
+        for head, head_weight in forward_level:
+            for tail, tail_weight in meeting.get(head[-1], ()):
+                if set(head[:-1]).isdisjoint(tail[:-1]):
+                    yield (list(head) + list(reversed(tail[:-1])),
+                           (head_weight + tail_weight) / length)
+
+def assemble_contig(path, kmer_size=None):
+    """Return the sequence spelled by a path of (k-1)-mers.
+      :Parameters:
+          path: List of nodes, packed codes when kmer_size is given
+          kmer_size: Size of the k-mers of a packed graph
+    """
+    if kmer_size is None:
+        return path[0] + "".join(node[-1] for node in path[1:])
+    return decode_kmer(path[0], kmer_size - 1) + "".join(
+        NUCLEOTIDES[node & 3] for node in path[1:])
+
+def iter_contigs(graph, starting_nodes, ending_nodes):
+    """Yield [contig, length] for each path from a starting node to an
+      ending node, contigs are assembled as paths are found.
+    """
+    kmer_size = graph.graph.get("kmer_size")
+    csr = build_csr(graph)
     for st_node in starting_nodes:
         for en_node in ending_nodes:
-            if nx.has_path(graph,st_node,en_node) is False:
-                break
-            for n in nx.all_simple_paths(graph,st_node,en_node):
-                contig = n[0]
-                for i in range(1,len(n)):
-                    kmer = n[i]
-                    contig += kmer[-1]
-                result.append([contig,len(contig)])
-    return result
+            for path in csr_simple_paths(csr.indptr, csr.indices,
+                                         csr.node_id[st_node],
+                                         csr.node_id[en_node]):
+                contig = assemble_contig([csr.nodes[i] for i in path],
+                                         kmer_size)
+                yield [contig, len(contig)]
+
+def get_contigs(graph, starting_nodes, ending_nodes):
+    return list(iter_contigs(graph, starting_nodes, ending_nodes))
 
 def save_contigs(contigs_list, output_file):
+    """Write contigs in fasta format.
+      :Parameters:
+          contigs_list: Iterable of (contig, length), consumed as it is
+                        written (see iter_contigs)
+          output_file: Path to the fasta file
+    """
     with open(output_file, "w") as file:
-        for i,element in enumerate(contigs_list):
-            file.write('>contig_'+str(i)+' len='+str(element[1])+'\n')
-            file.write(fill(element[0]))
-            file.write('\n')
+        for i, (contig, length) in enumerate(contigs_list):
+            file.write(">contig_{0} len={1}\n{2}\n".format(i, length,
+                                                           fill(contig)))
 
 
 def fill(text, width=80):
@@ -277,12 +638,15 @@ def main():
     # Get arguments
     args = get_arguments()
 
-    dict =build_kmer_dict(args.fastq_file,args.kmer_size)
-    graph = build_graph(dict)
+    if args.kmer_size <= MAX_PACKED_KMER_SIZE:
+        graph = build_graph(count_kmers(args.fastq_file, args.kmer_size),
+                            args.kmer_size)
+    else:
+        graph = build_graph(build_kmer_dict(args.fastq_file, args.kmer_size))
     graph = simplify_bubbles(graph)
     graph = solve_entry_tips(graph, get_starting_nodes(graph))
     graph = solve_out_tips(graph, get_sink_nodes(graph))
-    save_contigs(get_contigs(graph, get_starting_nodes(graph),get_sink_nodes(graph)), args.output_file)
+    save_contigs(iter_contigs(graph, get_starting_nodes(graph),get_sink_nodes(graph)), args.output_file)
 
 
     # Fonctions de dessin du graphe
@@ -9,6 +9,10 @@ from debruijn import get_starting_nodes
 from debruijn import get_sink_nodes
 from debruijn import get_contigs
 from debruijn import save_contigs
+from debruijn import iter_contigs
+from debruijn import build_csr
+from debruijn import csr_simple_paths
+from debruijn import bidirectional_simple_paths
 
 
 def test_get_starting_nodes():
@@ -38,6 +42,50 @@ def test_get_contigs():
         assert contig[1] == 8
 
 
+def test_get_contigs_unreachable_sink():
+    graph = nx.DiGraph()
+    graph.add_edges_from([("TC", "CA"), ("CA", "AG"), ("GG", "GT")])
+    contig_list = get_contigs(graph, ["TC", "GG"], ["GT", "AG"])
+    assert contig_list == [["TCAG", 4], ["GGT", 3]]
+
+
+def test_get_contigs_packed():
+    graph = debruijn.build_graph({debruijn.encode_kmer(kmer): 1 for kmer in
+                                  ["TCA", "CAG", "AGC", "GCG", "CGA", "GAT"]}, 3)
+    contig_list = get_contigs(graph, get_starting_nodes(graph), get_sink_nodes(graph))
+    assert contig_list == [["TCAGCGAT", 8]]
+
+
+def test_csr_simple_paths():
+    graph = nx.DiGraph()
+    graph.add_weighted_edges_from([(1, 2, 3), (2, 4, 1), (1, 3, 2), (3, 4, 5),
+                                   (4, 1, 1), (4, 5, 2)])
+    csr = build_csr(graph)
+    assert csr.indptr.tolist() == [0, 2, 3, 5, 6, 6]
+    assert [csr.nodes[i] for i in csr.indices[csr.indptr[0]:csr.indptr[1]]] == [2, 3]
+    assert csr.weights[csr.indptr[3]:csr.indptr[4]].tolist() == [5]
+    paths = [[csr.nodes[i] for i in path] for path in
+             csr_simple_paths(csr.indptr, csr.indices, csr.node_id[1], csr.node_id[5])]
+    assert paths == [list(p) for p in nx.all_simple_paths(graph, 1, 5)]
+    assert list(csr_simple_paths(csr.indptr, csr.indices, csr.node_id[1],
+                                 csr.node_id[5], cutoff=2)) == []
+    assert len(list(csr_simple_paths(csr.indptr, csr.indices, csr.node_id[1],
+                                     csr.node_id[5], cutoff=3))) == 2
+
+
+def test_bidirectional_simple_paths():
+    graph = nx.DiGraph()
+    graph.add_weighted_edges_from([(1, 2, 1), (2, 3, 2), (3, 4, 3), (4, 9, 4),
+                                   (1, 5, 5), (5, 9, 6), (1, 6, 7), (6, 7, 8),
+                                   (7, 9, 9), (2, 6, 1), (9, 1, 2), (1, 9, 3)])
+    paths = []
+    for path, weight in bidirectional_simple_paths(graph, 1, 9):
+        paths.append(path)
+        assert weight == debruijn.path_average_weight(graph, path)
+    assert sorted(paths) == sorted(list(p) for p in nx.all_simple_paths(graph, 1, 9))
+    assert [len(path) for path in paths] == sorted(len(path) for path in paths)
+    assert len(list(bidirectional_simple_paths(graph, 1, 9, cutoff=2))) == 2
+
 # def test_get_contigs_comp():
 #     graph = nx.DiGraph()
 #     graph.add_edges_from([(("AG", "TC"), ("CA", "GT")), (("AC", "TG"), ("CA", "GT")), (("CA", "GT"), ("AG", "TC")), 
@@ -56,4 +104,14 @@ def test_save_contigs():
     contig = [("TCAGCGAT", 8), ("TCAGCGAA",8), ("ACAGCGAT", 8), ("ACAGCGAA", 8)]
     save_contigs(contig, test_file)
     with open(test_file, 'rb') as contig_test:
-        assert hashlib.md5(contig_test.read()).hexdigest() == "ca84dfeb5d58eca107e34de09b3cc997"
\ No newline at end of file
+        assert hashlib.md5(contig_test.read()).hexdigest() == "ca84dfeb5d58eca107e34de09b3cc997"
+
+def test_save_contigs_stream(tmp_path):
+    graph = nx.DiGraph()
+    graph.add_edges_from([("TC", "CA"), ("AC", "CA"), ("CA", "AG"), ("AG", "GC"), ("GC", "CG"), ("CG", "GA"), ("GA", "AT"), ("GA", "AA")])
+    test_file = str(tmp_path / "stream.fna")
+    save_contigs(iter_contigs(graph, ["TC", "AC"], ["AT", "AA"]), test_file)
+    with open(test_file) as contig_test:
+        lines = contig_test.read().splitlines()
+    assert lines[::2] == [">contig_{0} len=8".format(i) for i in range(4)]
+    assert sorted(lines[1::2]) == ["ACAGCGAA", "ACAGCGAT", "TCAGCGAA", "TCAGCGAT"]
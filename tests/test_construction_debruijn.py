@@ -2,13 +2,25 @@
 import pytest
 import os
 import networkx as nx
+import numpy as np
 import pickle
+import gzip
+import shutil
 from .context import debruijn
 #from .context import debruijn_comp
 from debruijn import read_fastq
 from debruijn import cut_kmer
+from debruijn import cut_kmer_array
+from debruijn import encode_kmers
+from debruijn import pack_kmers_numpy
+from debruijn import pack_kmers_loop
+from debruijn import decode_kmers
+from debruijn import split_fastq
+from debruijn import count_kmers
 from debruijn import build_kmer_dict
 from debruijn import build_graph
+from debruijn import encode_kmer
+from debruijn import decode_kmer
 
 
 def test_read_fastq():
@@ -18,6 +30,15 @@ def test_read_fastq():
     assert next(fastq_reader) == "TTTGAATTACAACATCCATATGTTCTTGATGCTGGAATTCCAATATCTCAGTTGACAGTGTGCCCTCACCAGTGGATCAATTTACGAACCAACAATTGTG"
 
 
+def test_read_fastq_gzip(tmp_path):
+    """Test gzip compressed fastq reading"""
+    fastq_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "test_two_reads.fq"))
+    gzip_file = str(tmp_path / "test_two_reads.fq.gz")
+    with open(fastq_file, "rb") as src, gzip.open(gzip_file, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    assert list(read_fastq(gzip_file)) == list(read_fastq(fastq_file))
+
+
 def test_cut_kmer():
     """test Kmer cut"""
     kmer_reader = cut_kmer("TCAGA", 3)
@@ -26,6 +47,24 @@ def test_cut_kmer():
     assert next(kmer_reader) == "AGA"
 
 
+def test_cut_kmer_array():
+    windows = cut_kmer_array(b"TCAGA", 3)
+    assert windows.shape == (3, 3)
+    assert [bytes(kmer) for kmer in windows] == [b"TCA", b"CAG", b"AGA"]
+
+
+def test_encode_kmers():
+    codes = encode_kmers(b"TCAGNAGA", 3)
+    assert decode_kmers(codes, 3) == ["TCA", "CAG", "AGA"]
+
+
+def test_pack_kmers():
+    read = np.frombuffer(b"TCAGNAGAGGTACC\nAG\nGATTACA", dtype=np.uint8)
+    for kmer_size in (1, 3, 5):
+        assert (pack_kmers_numpy(read, kmer_size).tolist() ==
+                pack_kmers_loop(read, kmer_size).tolist())
+
+
 def test_build_kmer_dict():
     kmer_dict = build_kmer_dict(os.path.abspath(os.path.join(os.path.dirname(__file__), "test_build.fq")), 3)
     assert(len(kmer_dict.keys()) == 4)
@@ -34,6 +73,42 @@ def test_build_kmer_dict():
     assert "AGA" in kmer_dict
     assert "GAG" in kmer_dict
     assert kmer_dict["AGA"] == 2
+    # K-mers too long to be packed
+    fastq_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "test_two_reads.fq"))
+    kmer_dict = build_kmer_dict(fastq_file, 99)
+    assert sorted(kmer_dict) == sorted(kmer for read in read_fastq(fastq_file)
+                                       for kmer in cut_kmer(read, 99))
+    assert set(kmer_dict.values()) == {1}
+
+
+def test_build_kmer_dict_invalid_base(tmp_path):
+    fastq_file = str(tmp_path / "n_base.fq")
+    halves = ["TCAGAGCTCTAGAGTTGGTTCTGAGAGAGATCGG", "TTACTCGGAGGAGGCTGTGTCACTCATAGAAGGGA"]
+    read = "N".join(halves)
+    with open(fastq_file, "w") as fastq:
+        fastq.write("@read\n{0}\n+\n{1}\n".format(read, "J" * len(read)))
+    for kmer_size in (21, 32, 33):
+        assert build_kmer_dict(fastq_file, kmer_size) == {
+            kmer: 1 for half in halves for kmer in cut_kmer(half, kmer_size)}
+
+def test_split_fastq(tmp_path):
+    fastq_file = str(tmp_path / "quality_at.fq")
+    record = b"@read\nTCAGAGA\n+\n@@J@J@@\n"
+    with open(fastq_file, "wb") as fastq:
+        fastq.write(record * 50)
+    chunks = split_fastq(fastq_file, 7)
+    assert len(chunks) == 7
+    assert chunks[0][0] == 0
+    assert chunks[-1][1] == len(record) * 50
+    for (start, end), (next_start, _) in zip(chunks, chunks[1:]):
+        assert end == next_start
+        assert start % len(record) == 0
+
+
+def test_count_kmers_parallel():
+    fastq_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "../data/eva71_plus_perfect.fq"))
+    assert count_kmers(fastq_file, 21, nb_process=3) == count_kmers(fastq_file, 21, nb_process=1)
+
 
 def test_build_graph():
     file = open(os.path.abspath(os.path.join(os.path.dirname(__file__), "kmer.pck")),'rb')
@@ -52,6 +127,15 @@ def test_build_graph():
     assert graph.edges["AG", "GA"]['weight'] == 2
     file.close()
 
+def test_build_graph_packed():
+    kmer_dict = {encode_kmer(kmer): occ for kmer, occ
+                 in {"TCA": 1, "CAG": 1, "AGA": 2, "GAG": 1}.items()}
+    graph = build_graph(kmer_dict, 3)
+    assert graph.number_of_nodes() == 4
+    assert graph.number_of_edges() == 4
+    assert graph.edges[encode_kmer("AG"), encode_kmer("GA")]['weight'] == 2
+    assert decode_kmer(encode_kmer("TC"), 2) == "TC"
+
 # def test_build_graph_comp():
 #     file = open(os.path.abspath(os.path.join(os.path.dirname(__file__), "kmer_comp.pck")),'rb')
 #     kmer_dict = pickle.load(file)
@@ -16,6 +16,8 @@ from debruijn import solve_out_tips
 
 def test_std():
     assert round(std([9, 5, 15, 20]), 1) == 6.6
+    assert std([9]) == 0
+    assert std([]) == 0
 
 
 def test_path_weight():
@@ -23,6 +25,9 @@ def test_path_weight():
     graph.add_weighted_edges_from([(1, 2, 5), (3, 2, 10), (2, 4, 10), (4, 5, 3), 
                                    (5, 6, 10), (5, 7, 10)])
     assert path_average_weight(graph, [1, 2, 4, 5] ) == 6.0
+    # Edges between path nodes that are not on the path are ignored
+    graph.add_weighted_edges_from([(1, 4, 100), (5, 2, 100)])
+    assert path_average_weight(graph, [1, 2, 4, 5] ) == 6.0
 
 def test_remove_paths():
     graph_1 = nx.DiGraph()
@@ -130,6 +135,19 @@ def test_solve_bubble():
     assert (9,5) in graph_2.edges()
 
 
+def test_solve_bubble_packed():
+    graph = nx.DiGraph()
+    graph.graph["kmer_size"] = 3
+    graph.add_weighted_edges_from([(0, 1, 2), (1, 9, 2), (0, 2, 3), (2, 9, 3),
+                                   (0, 10, 20), (20, 9, 20)])
+    graph.add_weighted_edges_from([(node, node + 1, 20) for node in range(10, 20)])
+    graph = solve_bubble(graph, 0, 9)
+    assert 1 not in graph.nodes()
+    assert 2 not in graph.nodes()
+    assert nx.has_path(graph, 0, 9)
+    assert all(node in graph.nodes() for node in range(10, 21))
+
+
 def test_simplify_bubbles():
     graph_1 = nx.DiGraph()
     graph_1.add_weighted_edges_from([(3, 2, 10), (2, 4, 15), (4, 5, 15),